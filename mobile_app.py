@@ -1,10 +1,11 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime
 import requests
-from io import StringIO
+from io import StringIO, BytesIO
 
 # Configuração mobile-first
 st.set_page_config(
@@ -343,7 +344,11 @@ def carregar_planilha(url):
         response = requests.get(csv_url, timeout=10)
         response.raise_for_status()
         
-        df = pd.read_csv(StringIO(response.text))
+        # engine pyarrow (multi-thread) direto dos bytes; se não der, engine C sobre o texto
+        try:
+            df = pd.read_csv(BytesIO(response.content), engine='pyarrow')
+        except (ImportError, ValueError):
+            df = pd.read_csv(StringIO(response.text))
         
         required_cols = ['codigo', 'nome', 'categoria', 'estoque_atual', 'estoque_min', 'estoque_max', 'custo_unitario']
         missing_cols = [col for col in required_cols if col not in df.columns]
@@ -364,14 +369,25 @@ def carregar_planilha(url):
         st.error(f"❌ Erro ao carregar: {str(e)}")
         return pd.DataFrame()
 
+# Status possíveis (ordem usada em filtros, contagens e gráficos)
+STATUS_CATEGORIAS = ['CRÍTICO', 'ATENÇÃO', 'OK']
+
+@st.cache_data(show_spinner=False)
 def adicionar_status(df):
     if df.empty:
         return df
     
-    df['status'] = df.apply(lambda row: 
-        'CRÍTICO' if row['estoque_atual'] <= row['estoque_min']
-        else 'ATENÇÃO' if row['estoque_atual'] <= row['estoque_min'] * 1.5
-        else 'OK', axis=1)
+    # categoria como category: unique()/groupby passam a custar O(#categorias)
+    df['categoria'] = df['categoria'].astype('category')
+    # chave de busca pré-calculada (código + nome, minúsculo): a busca vira um único contains
+    df['busca'] = (df['codigo'].astype(str) + '\n' + df['nome'].astype(str)).str.lower()
+    
+    # classificação vetorizada (uma passada em C em vez de um lambda por linha)
+    atual = df['estoque_atual'].to_numpy()
+    minimo = df['estoque_min'].to_numpy()
+    status = np.select([atual <= minimo, atual <= minimo * 1.5], ['CRÍTICO', 'ATENÇÃO'], default='OK')
+    # status como Categorical: filtros por igualdade e value_counts comparam códigos inteiros
+    df['status'] = pd.Categorical(status, categories=STATUS_CATEGORIAS)
     
     df['semaforo'] = df['status'].map({
         'OK': '🟢',
@@ -381,6 +397,20 @@ def adicionar_status(df):
     
     return df
 
+@st.cache_data(show_spinner=False)
+def listar_categorias(df):
+    return ['Todas'] + sorted(df['categoria'].dropna().unique().tolist())
+
+def to_csv_bytes(df):
+    # serializa direto em bytes (utf-8 com BOM, para o Excel abrir acentos) sem str intermediária
+    buf = BytesIO()
+    buf.write(b'\xef\xbb\xbf')
+    df.to_csv(buf, index=False, encoding='utf-8', lineterminator='\n')
+    return buf.getvalue()
+
+# Opções fixas do filtro de status
+STATUS_OPCOES = ['Todos'] + STATUS_CATEGORIAS
+
 # Header Mobile
 st.markdown("""
 <div class="mobile-header fade-in">
@@ -439,7 +469,7 @@ if not sheets_url:
     st.subheader("📄 Template da Planilha")
     st.dataframe(template_df, use_container_width=True)
     
-    csv_template = template_df.to_csv(index=False)
+    csv_template = to_csv_bytes(template_df)
     st.download_button(
         label="📥 Baixar Template",
         data=csv_template,
@@ -463,10 +493,12 @@ produtos_df = adicionar_status(produtos_df)
 st.success(f"✅ {len(produtos_df)} produtos carregados • {datetime.now().strftime('%H:%M:%S')}")
 
 # Métricas principais (mobile grid)
+# uma única contagem por status (Categorical: todas as categorias presentes, mesmo zeradas)
+contagem_status = produtos_df['status'].value_counts()
 total_produtos = len(produtos_df)
-produtos_ok = len(produtos_df[produtos_df['status'] == 'OK'])
-produtos_atencao = len(produtos_df[produtos_df['status'] == 'ATENÇÃO'])
-produtos_criticos = len(produtos_df[produtos_df['status'] == 'CRÍTICO'])
+produtos_ok = int(contagem_status['OK'])
+produtos_atencao = int(contagem_status['ATENÇÃO'])
+produtos_criticos = int(contagem_status['CRÍTICO'])
 
 st.markdown(f"""
 <div class="metric-grid fade-in">
@@ -500,14 +532,14 @@ with tab1:
     with col_f1:
         categoria_filter = st.selectbox(
             "📂 Categoria:",
-            ['Todas'] + sorted(produtos_df['categoria'].unique().tolist()),
+            listar_categorias(produtos_df),
             key="mobile_cat"
         )
     
     with col_f2:
         status_filter = st.selectbox(
             "🚦 Status:",
-            ['Todos', 'CRÍTICO', 'ATENÇÃO', 'OK'],
+            STATUS_OPCOES,
             key="mobile_status"
         )
     
@@ -525,34 +557,31 @@ with tab1:
         df_filtrado = df_filtrado[df_filtrado['status'] == status_filter]
     
     if busca_produto:
-        mask = (df_filtrado['nome'].str.contains(busca_produto, case=False, na=False) | 
-                df_filtrado['codigo'].str.contains(busca_produto, case=False, na=False))
+        mask = df_filtrado['busca'].str.contains(busca_produto.lower(), regex=False)
         df_filtrado = df_filtrado[mask]
     
     # Lista de produtos mobile
     if len(df_filtrado) > 0:
-        st.markdown('<div class="product-list fade-in">', unsafe_allow_html=True)
-        
-        for _, produto in df_filtrado.iterrows():
-            status_class = {
-                'OK': 'status-ok',
-                'ATENÇÃO': 'status-warning', 
-                'CRÍTICO': 'status-danger'
-            }.get(produto['status'], 'status-ok')
-            
-            st.markdown(f"""
-            <div class="product-item">
-                <div class="product-info">
-                    <div class="product-name">{produto['semaforo']} {produto['nome']}</div>
-                    <div class="product-details">{produto['codigo']} • {produto['categoria']} • Estoque: {produto['estoque_atual']}/{produto['estoque_min']}</div>
-                </div>
-                <div class="product-status">
-                    <span class="status-badge {status_class}">{produto['status']}</span>
-                </div>
-            </div>
-            """, unsafe_allow_html=True)
+        classes_status = {
+            'OK': 'status-ok',
+            'ATENÇÃO': 'status-warning',
+            'CRÍTICO': 'status-danger'
+        }
         
-        st.markdown('</div>', unsafe_allow_html=True)
+        # monta a lista inteira e envia numa única chamada (um elemento no frontend, não um por produto)
+        itens_html = ''.join(
+            f'<div class="product-item">'
+            f'<div class="product-info">'
+            f'<div class="product-name">{p.semaforo} {p.nome}</div>'
+            f'<div class="product-details">{p.codigo} • {p.categoria} • Estoque: {p.estoque_atual}/{p.estoque_min}</div>'
+            f'</div>'
+            f'<div class="product-status">'
+            f'<span class="status-badge {classes_status.get(p.status, "status-ok")}">{p.status}</span>'
+            f'</div>'
+            f'</div>'
+            for p in df_filtrado.itertuples(index=False)
+        )
+        st.markdown(f'<div class="product-list fade-in">{itens_html}</div>', unsafe_allow_html=True)
         st.caption(f"📊 Mostrando {len(df_filtrado)} de {len(produtos_df)} produtos")
     else:
         st.info("🔍 Nenhum produto encontrado com os filtros aplicados")
@@ -561,7 +590,7 @@ with tab2:
     # Gráfico de distribuição mobile
     st.markdown('<div class="chart-container-mobile fade-in">', unsafe_allow_html=True)
     
-    status_counts = produtos_df['status'].value_counts()
+    status_counts = contagem_status[contagem_status > 0]
     
     fig_pie = px.pie(
         values=status_counts.values,
@@ -588,7 +617,7 @@ with tab2:
     # Gráfico por categoria mobile
     st.markdown('<div class="chart-container-mobile fade-in">', unsafe_allow_html=True)
     
-    categoria_stats = produtos_df.groupby('categoria').agg({
+    categoria_stats = produtos_df.groupby('categoria', observed=True).agg({
         'estoque_atual': 'sum',
         'codigo': 'count'
     }).reset_index()
@@ -634,7 +663,7 @@ with tab3:
             
             st.dataframe(relatorio, use_container_width=True)
             
-            csv_data = relatorio.to_csv(index=False)
+            csv_data = to_csv_bytes(relatorio)
             st.download_button(
                 label="💾 Baixar CSV",
                 data=csv_data,
@@ -667,7 +696,7 @@ with tab3:
         
         st.dataframe(relatorio_final, use_container_width=True)
         
-        csv_data = relatorio_final.to_csv(index=False)
+        csv_data = to_csv_bytes(relatorio_final)
         st.download_button(
             label="💾 Baixar CSV",
             data=csv_data,
@@ -679,11 +708,11 @@ with tab3:
     st.markdown('</div>', unsafe_allow_html=True)
 
 # Alertas críticos (sempre visível)
-produtos_criticos_lista = produtos_df[produtos_df['status'] == 'CRÍTICO']
-if len(produtos_criticos_lista) > 0:
+total_criticos = int(contagem_status['CRÍTICO'])
+if total_criticos > 0:
     st.markdown(f"""
     <div class="alert-danger-mobile fade-in">
-        <strong>🚨 {len(produtos_criticos_lista)} produto(s) crítico(s)!</strong><br>
+        <strong>🚨 {total_criticos} produto(s) crítico(s)!</strong><br>
         Necessária reposição urgente de estoque.
     </div>
     """, unsafe_allow_html=True)
@@ -1,7 +1,11 @@
 import io
 import re
+import itertools
 import json
 import time
+from collections import defaultdict
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 import streamlit as st
 
@@ -9,10 +13,26 @@ import streamlit as st
 import gspread
 from google.oauth2.service_account import Credentials
 
+# Excel
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
 
 # =========================
 # Helpers: Secrets / Config
 # =========================
+def clean_gid(x: str) -> str:
+    """
+    Aceita "123" ou "gid=123" (copiado da URL).
+    """
+    x = str(x or "").strip()
+    # caso comum: já veio só o número
+    if x.isdigit():
+        return x
+    return x.replace("gid=", "").strip()
+
+
 def get_app_config_defaults():
     """
     Puxa defaults do st.secrets, se existirem.
@@ -29,11 +49,6 @@ def get_app_config_defaults():
     except Exception:
         cfg = {}
 
-    def clean_gid(x: str) -> str:
-        x = str(x or "").strip()
-        x = x.replace("gid=", "").strip()
-        return x
-
     return {
         "spreadsheet_id": str(cfg.get("spreadsheet_id", "")).strip(),
         "gid_template_estoque": clean_gid(cfg.get("gid_template_estoque", "")),
@@ -42,11 +57,13 @@ def get_app_config_defaults():
     }
 
 
+@st.cache_resource(show_spinner=False)
 def get_gspread_client():
     """
     Lê credenciais do Service Account em st.secrets.
     Você pode ter colocado como chaves soltas (private_key, client_email, etc)
     OU como JSON completo dentro de alguma chave.
+    O client autorizado fica em cache (cache_resource) e é reaproveitado entre reruns.
     """
     # Escopos necessários para ler planilhas
     scopes = [
@@ -86,7 +103,25 @@ def get_gspread_client():
     )
 
 
-def gid_to_sheet_name(spreadsheet, gid: str) -> str:
+@st.cache_data(max_entries=64, show_spinner=False, hash_funcs={gspread.Spreadsheet: lambda sh: sh.id})
+def sheet_titles_by_gid(spreadsheet, revision: str) -> dict:
+    """
+    Mapa gid -> título de todas as abas da planilha.
+    Um único fetch_sheet_metadata por revisão (renomear/criar aba muda a revisão).
+    """
+    try:
+        meta = spreadsheet.fetch_sheet_metadata()
+    except Exception as e:
+        raise RuntimeError(f"Falha ao resolver GID->Nome da aba. Erro: {e}")
+
+    out = {}
+    for s in meta.get("sheets", []):
+        props = s.get("properties", {})
+        out[str(props.get("sheetId"))] = props.get("title")
+    return out
+
+
+def gid_to_sheet_name(spreadsheet, gid: str, revision: str) -> str:
     """
     Converte gid -> sheet title.
     (Sem isso, ficamos dependentes do nome exato da aba.)
@@ -96,71 +131,134 @@ def gid_to_sheet_name(spreadsheet, gid: str) -> str:
         raise ValueError("GID vazio.")
 
     try:
-        meta = spreadsheet.fetch_sheet_metadata()
-        for s in meta.get("sheets", []):
-            props = s.get("properties", {})
-            if str(props.get("sheetId")) == gid:
-                return props.get("title")
-    except Exception as e:
-        raise RuntimeError(f"Falha ao resolver GID->Nome da aba. Erro: {e}")
+        return sheet_titles_by_gid(spreadsheet, revision)[gid]
+    except KeyError:
+        raise ValueError(f"Não achei nenhuma aba com gid={gid} nesse Spreadsheet.")
 
-    raise ValueError(f"Não achei nenhuma aba com gid={gid} nesse Spreadsheet.")
 
+@st.cache_data(ttl=30, show_spinner=False)
+def get_sheet_revision(spreadsheet_id: str) -> str:
+    """
+    modifiedTime do arquivo no Drive: só muda quando alguém edita a planilha.
+    Se o Drive API não responder (API desabilitada no projeto, escopo etc),
+    cai numa "revisão" por janela de 60s — mesmo comportamento do TTL antigo.
+    """
+    try:
+        gc = get_gspread_client()
+        return str(gc.get_file_drive_metadata(spreadsheet_id)["modifiedTime"])
+    except Exception:
+        return f"ttl-{int(time.time() // 60)}"
 
-@st.cache_data(ttl=60, show_spinner=False)
-def load_sheet_as_df(spreadsheet_id: str, gid: str) -> pd.DataFrame:
-    gc = get_gspread_client()
-    sh = gc.open_by_key(spreadsheet_id)
-    title = gid_to_sheet_name(sh, gid)
-    ws = sh.worksheet(title)
-    values = ws.get_all_values()
+
+def load_sheets_as_dfs(spreadsheet_id: str, gids: list) -> list:
+    """
+    Lê várias abas (gids) da mesma planilha numa única chamada à API
+    (values_batch_get com todos os ranges), na ordem dos gids.
+    """
+    revision = get_sheet_revision(spreadsheet_id)
+    gids = tuple(str(g).strip() for g in gids)
+    return list(load_sheets_at_revision(spreadsheet_id, gids, revision))
+
+
+def values_to_df(values: list) -> pd.DataFrame:
+    """
+    Converte a matriz de valores da API (1ª linha = cabeçalho) em DataFrame.
+    """
     if not values or len(values) < 2:
         return pd.DataFrame()
 
-    header = values[0]
+    header = [str(h) for h in values[0]]
     rows = values[1:]
-    df = pd.DataFrame(rows, columns=header)
-    # remove colunas vazias
-    df = df.loc[:, [c for c in df.columns if str(c).strip() != ""]]
+    # monta por coluna (transpõe uma vez em C) e já descarta colunas sem nome;
+    # a API omite células vazias no fim da linha, então completa com ""
+    cols = list(itertools.zip_longest(header, *rows, fillvalue=""))
+    keep = [i for i, h in enumerate(header) if h.strip() != ""]
+    df = pd.DataFrame({i: pd.array(cols[i][1:], dtype="string[pyarrow]") for i in keep})
+    df.columns = [header[i] for i in keep]
     return df
 
 
+# a revisão só muda com edição direta; valores recalculados (IMPORTRANGE, NOW, fórmulas
+# entre abas) não mexem no modifiedTime, então o ttl é o teto de desatualização
+@st.cache_data(ttl=600, max_entries=64, show_spinner=False)
+def load_sheets_at_revision(spreadsheet_id: str, gids: tuple, revision: str) -> tuple:
+    gc = get_gspread_client()
+    sh = gc.open_by_key(spreadsheet_id)
+    titles = [gid_to_sheet_name(sh, gid, revision) for gid in gids]
+    # valores formatados (texto exibido), como no get_all_values: em planilha pt-BR uma lista
+    # "1,2" nas células de BOM é guardada como o número 1.2 e só o texto preserva os dois itens
+    resp = sh.values_batch_get(
+        ranges=["'{}'".format(t.replace("'", "''")) for t in titles],
+        params={"valueRenderOption": "FORMATTED_VALUE"},
+    )
+    value_ranges = resp.get("valueRanges", [])
+    # valueRanges volta na mesma ordem dos ranges pedidos
+    return tuple(
+        values_to_df(value_ranges[i].get("values", []) if i < len(value_ranges) else [])
+        for i in range(len(gids))
+    )
+
+
 # =========================
 # Parsing (BOM cells)
 # =========================
+# primeiro número "solto" dentro de um texto (fallback dos parsers numéricos)
+_NUM_RE = re.compile(r"[-+]?\d*\.?\d+")
+# separador de listas nas células ("a, b ,c"): já consome os espaços em volta da vírgula
+_SPLIT_COMMA = re.compile(r"\s*,\s*")
+
+
+# conteúdos de célula que não são código de insumo (vazio / placeholders usados na planilha)
+_NOT_A_CODE = frozenset({"", "nan", "none", "sem gola", "sem bordado", "nao tem", "não tem"})
+
+
+def looks_like_code(x: str) -> bool:
+    """
+    x já deve vir com strip().
+    """
+    return x.lower() not in _NOT_A_CODE
+
+
+# As células de BOM se repetem muito (mesmos códigos/qtds em várias linhas),
+# então os parsers abaixo são memoizados e devolvem tuplas (imutáveis, seguras p/ cache).
+@lru_cache(maxsize=65536, typed=True)
 def split_csv_like(x):
     if x is None:
-        return []
+        return ()
     s = str(x).strip()
     if s == "" or s.lower() == "nan":
-        return []
+        return ()
     # aceita separador ","
-    parts = [p.strip() for p in s.split(",")]
-    return [p for p in parts if p != ""]
+    return tuple(p for p in _SPLIT_COMMA.split(s) if p != "")
 
 
+@lru_cache(maxsize=65536, typed=True)
 def parse_number_list(x):
     """
-    Converte "1,2, 3" -> [1.0, 2.0, 3.0]
-    Aceita também "1" -> [1.0]
+    Converte "1,2, 3" -> (1.0, 2.0, 3.0)
+    Aceita também "1" -> (1.0,)
     """
     parts = split_csv_like(x)
     out = []
     for p in parts:
-        p2 = p.replace(" ", "").replace(",", ".")
+        # (vírgula já foi consumida pelo split)
+        p2 = p.replace(" ", "")
         # Se vier "1.2.3" evita explodir
         try:
             out.append(float(p2))
         except Exception:
             # tenta extrair número
-            m = re.findall(r"[-+]?\d*\.?\d+", p2)
-            out.append(float(m[0]) if m else 0.0)
-    return out
+            m = _NUM_RE.search(p2)
+            out.append(float(m.group()) if m else 0.0)
+    return tuple(out)
 
 
 def safe_float(x, default=0.0):
     if x is None:
         return default
+    # número de verdade (valor cru da planilha/Excel): converte direto, sem str/try
+    if isinstance(x, (int, float)) and not isinstance(x, bool):
+        return default if x != x else float(x)
     s = str(x).strip()
     if s == "" or s.lower() == "nan":
         return default
@@ -168,35 +266,81 @@ def safe_float(x, default=0.0):
     try:
         return float(s)
     except Exception:
-        m = re.findall(r"[-+]?\d*\.?\d+", s)
-        return float(m[0]) if m else default
+        m = _NUM_RE.search(s)
+        return float(m.group()) if m else default
+
+
+def as_text(s: pd.Series) -> pd.Series:
+    """
+    Coluna como texto para os métodos .str. Colunas que já são string
+    (string[pyarrow] do loader) seguem direto nos kernels Arrow, sem
+    astype(str) materializar um objeto Python por célula.
+    """
+    return s if isinstance(s.dtype, pd.StringDtype) else s.astype(str)
+
+
+def safe_float_series(s: pd.Series, default=0.0) -> pd.Series:
+    """
+    Versão vetorizada de safe_float para uma coluna inteira.
+    Caminho rápido via pd.to_numeric; só as células que não convertem direto
+    (vazias, "nan", lixo no meio do número) caem no safe_float célula a célula.
+    """
+    txt = as_text(s).str.strip().str.replace(",", ".", regex=False)
+    out = pd.to_numeric(txt, errors="coerce").astype(float)
+    bad = out.isna()
+    if bad.any():
+        out.loc[bad] = s.loc[bad].map(lambda x: safe_float(x, default))
+    return out
+
+
+def normalize_code_series(s: pd.Series) -> pd.Series:
+    """
+    Normaliza uma coluna inteira de códigos de uma vez: texto sem espaços nas pontas.
+    Células vazias / NaN / "nan" viram "" (linha a descartar).
+    """
+    codes = as_text(s.fillna("")).str.strip()
+    return codes.where(codes.str.lower() != "nan", "")
 
 
 # =========================
 # Sales file normalization
 # =========================
-def read_sales_file(uploaded_file) -> pd.DataFrame:
-    name = uploaded_file.name.lower()
-    if name.endswith(".csv"):
-        df = pd.read_csv(uploaded_file)
-    elif name.endswith(".xlsx") or name.endswith(".xls"):
-        df = pd.read_excel(uploaded_file)
-    else:
-        raise ValueError("Formato inválido. Use CSV ou XLSX.")
+def detect_csv_encoding(uploaded_file, sample_size: int = 65536) -> str:
+    """
+    Decide o encoding olhando só uma amostra do início do arquivo (uma leitura, um parse):
+    BOM -> utf-8-sig; amostra decodifica como UTF-8 -> utf-8; senão latin1 (planilhas do Excel BR).
+    """
+    head = uploaded_file.read(sample_size)
+    uploaded_file.seek(0)
+    if head.startswith(b"\xef\xbb\xbf"):
+        return "utf-8-sig"
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # amostra pode ter cortado um caractere multibyte no final
+        if len(head) < sample_size or e.start < len(head) - 3:
+            return "latin1"
+    return "utf-8"
 
-    # normaliza colunas
-    df.columns = [str(c).strip().lower() for c in df.columns]
 
-    # tenta achar "codigo" e "quantidade"
-    code_candidates = ["codigo", "código", "sku", "produto", "cod", "code"]
-    qty_candidates = ["quantidade", "qtd", "qtde", "qty", "quant", "qtd_vendida", "vendido"]
+# nomes aceitos (já normalizados) para as colunas de vendas
+_SALES_CODE_NAMES = frozenset({"codigo", "código", "sku", "produto", "cod", "code"})
+_SALES_QTY_NAMES = frozenset({"quantidade", "qtd", "qtde", "qty", "quant", "qtd_vendida", "vendido"})
+
+
+def resolve_sales_columns(columns) -> tuple:
+    """
+    Acha as colunas de código e quantidade (nomes já normalizados: strip + lower).
+    """
+    columns = list(columns)
 
-    code_col = next((c for c in df.columns if c in code_candidates), None)
-    qty_col = next((c for c in df.columns if c in qty_candidates), None)
+    # tenta achar "codigo" e "quantidade"
+    code_col = next((c for c in columns if c in _SALES_CODE_NAMES), None)
+    qty_col = next((c for c in columns if c in _SALES_QTY_NAMES), None)
 
     if code_col is None or qty_col is None:
         # tentativa por contains
-        for c in df.columns:
+        for c in columns:
             if code_col is None and "cod" in c:
                 code_col = c
             if qty_col is None and ("qtd" in c or "quant" in c):
@@ -205,17 +349,56 @@ def read_sales_file(uploaded_file) -> pd.DataFrame:
     if code_col is None or qty_col is None:
         raise KeyError("Não encontrei colunas de vendas. Preciso de colunas: codigo / quantidade.")
 
+    return code_col, qty_col
+
+
+def read_excel_any(uploaded_file, **kwargs) -> pd.DataFrame:
+    """
+    read_excel com o engine calamine (Rust; lê .xlsx e .xls) quando disponível,
+    senão o engine padrão do pandas (openpyxl / xlrd).
+    O calamine carrega a aba inteira a cada chamada (nrows/usecols não
+    encurtam o parse): ler o arquivo uma vez só.
+    """
+    try:
+        return pd.read_excel(uploaded_file, engine="calamine", **kwargs)
+    except ImportError:
+        uploaded_file.seek(0)
+        return pd.read_excel(uploaded_file, **kwargs)
+
+
+def read_sales_file(uploaded_file) -> pd.DataFrame:
+    name = uploaded_file.name.lower()
+    if name.endswith(".csv"):
+        enc = detect_csv_encoding(uploaded_file)
+        # engine pyarrow (multi-thread); se não estiver disponível ou não entender o arquivo, volta pro engine C
+        try:
+            df = pd.read_csv(uploaded_file, encoding=enc, engine="pyarrow")
+        except (ImportError, ValueError):
+            uploaded_file.seek(0)
+            df = pd.read_csv(uploaded_file, encoding=enc)
+    elif name.endswith(".xlsx") or name.endswith(".xls"):
+        # uma única leitura, tudo como texto (SKU numérico vem "123", não "123.0");
+        # as 2 colunas são escolhidas depois, como no CSV
+        df = read_excel_any(uploaded_file, dtype=str)
+    else:
+        raise ValueError("Formato inválido. Use CSV ou XLSX.")
+
+    # normaliza colunas
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    code_col, qty_col = resolve_sales_columns(df.columns)
+
     df = df[[code_col, qty_col]].copy()
     df.columns = ["codigo", "quantidade"]
 
-    df["codigo"] = df["codigo"].astype(str).str.strip()
-    df["quantidade"] = df["quantidade"].apply(lambda x: safe_float(x, 0)).astype(float)
+    df["codigo"] = normalize_code_series(df["codigo"])
+    df["quantidade"] = safe_float_series(df["quantidade"], 0).astype(float)
 
     df = df[df["codigo"].str.len() > 0]
     df = df[df["quantidade"] > 0]
 
-    # agrupa
-    df = df.groupby("codigo", as_index=False)["quantidade"].sum()
+    # agrupa (codigo como category: o groupby usa os códigos inteiros; sort=False mantém a ordem do arquivo)
+    df["codigo"] = df["codigo"].astype("category")
+    df = df.groupby("codigo", as_index=False, observed=True, sort=False)["quantidade"].sum()
     df["quantidade"] = df["quantidade"].round(3)
     return df
 
@@ -223,6 +406,7 @@ def read_sales_file(uploaded_file) -> pd.DataFrame:
 # =========================
 # Stock / BOM indexing
 # =========================
+@st.cache_data(show_spinner=False)
 def build_stock_map(df_template: pd.DataFrame) -> dict:
     """
     Espera colunas: codigo, estoque_atual
@@ -242,68 +426,100 @@ def build_stock_map(df_template: pd.DataFrame) -> dict:
         else:
             raise KeyError("Aba template_estoque precisa ter colunas: codigo e estoque_atual.")
 
-    df = df_template.copy()
-    df["codigo"] = df["codigo"].astype(str).str.strip()
-    df["estoque_atual"] = df["estoque_atual"].apply(lambda x: safe_float(x, 0)).astype(float)
+    # tolist(): conversão em lote para str/float do Python (sem np.float64 por item no dict)
+    codes = as_text(df_template["codigo"].fillna("")).str.strip().tolist()
+    qtys = safe_float_series(df_template["estoque_atual"], 0).tolist()
+    return dict(zip(codes, qtys))
 
-    stock = {}
-    for _, r in df.iterrows():
-        code = r["codigo"]
-        qty = float(r["estoque_atual"])
-        stock[code] = qty
 
-    return stock
+# colunas das abas de BOM (tuplas na ordem das mensagens de erro; frozensets para a checagem)
+SIMPLES_REQUIRED = ("codigo_final", "semi_codigo", "semi_qtd", "gola_codigo", "gola_qtd")
+SIMPLES_OPTIONAL = ("bordado_codigo", "bordado_qtd", "extras_codigos", "extras_qtds")
+_SIMPLES_REQUIRED_SET = frozenset(SIMPLES_REQUIRED)
+KITS_REQUIRED = ("codigo_final", "componentes_codigos", "componentes_qtds")
+_KITS_REQUIRED_SET = frozenset(KITS_REQUIRED)
 
 
+@st.cache_data(show_spinner=False)
 def index_bom_simples(df_simple: pd.DataFrame) -> dict:
     """
-    Retorna dict: codigo_final -> row dict
+    Retorna dict: codigo_final -> tupla de insumos (categoria, codigo, qtd por unidade)
     """
     if df_simple.empty:
         return {}
     df = df_simple.copy()
     df.columns = [str(c).strip().lower() for c in df.columns]
-    required = ["codigo_final", "semi_codigo", "semi_qtd", "gola_codigo", "gola_qtd", "bordado_codigo", "bordado_qtd", "extras_codigos", "extras_qtds"]
-    for col in required:
+    missing = _SIMPLES_REQUIRED_SET.difference(df.columns)
+    if missing:
+        col = next(c for c in SIMPLES_REQUIRED if c in missing)
+        raise KeyError(f"Aba bom_produto_simples precisa da coluna: {col}")
+    # aceita ausência de extras/bordado
+    for col in SIMPLES_OPTIONAL:
         if col not in df.columns:
-            # aceita ausência de extras/bordado
-            if col in ["bordado_codigo", "bordado_qtd", "extras_codigos", "extras_qtds"]:
-                df[col] = ""
-            else:
-                raise KeyError(f"Aba bom_produto_simples precisa da coluna: {col}")
+            df[col] = ""
+    df = df[list(SIMPLES_REQUIRED + SIMPLES_OPTIONAL)]
 
+    # normaliza de uma vez as colunas de código
+    for col in ["codigo_final", "semi_codigo", "gola_codigo", "bordado_codigo", "extras_codigos"]:
+        df[col] = normalize_code_series(df[col])
+    df = df[df["codigo_final"] != ""]
+
+    # parse coluna a coluna (uma passada por coluna, quantidades simples vetorizadas)
     out = {}
-    for _, r in df.iterrows():
-        code = str(r["codigo_final"]).strip()
-        if not code or code.lower() == "nan":
-            continue
-        out[code] = dict(r)
+    for code, semi_code, semi_qtd, gola_codes, gola_qtds, bord_code, bord_qtd, extra_codes, extra_qtds in zip(
+        df["codigo_final"].to_numpy(),
+        df["semi_codigo"].to_numpy(),
+        safe_float_series(df["semi_qtd"], 0).to_numpy(),
+        df["gola_codigo"].map(split_csv_like).to_numpy(),
+        df["gola_qtd"].map(parse_number_list).to_numpy(),
+        df["bordado_codigo"].to_numpy(),
+        safe_float_series(df["bordado_qtd"], 0).to_numpy(),
+        df["extras_codigos"].map(split_csv_like).to_numpy(),
+        df["extras_qtds"].map(parse_number_list).to_numpy(),
+    ):
+        # Ajustes de tamanhos
+        if len(gola_qtds) < len(gola_codes):
+            gola_qtds = gola_qtds + (1.0,) * (len(gola_codes) - len(gola_qtds))
+        if len(extra_qtds) < len(extra_codes):
+            extra_qtds = extra_qtds + (1.0,) * (len(extra_codes) - len(extra_qtds))
+
+        # lista final de insumos (categoria, codigo, qtd por unidade), já sem placeholders
+        reqs = [("SEMI", semi_code, semi_qtd)]
+        reqs += [("GOLA", gc, gq) for gc, gq in zip(gola_codes, gola_qtds)]
+        reqs.append(("BORDADO", bord_code, bord_qtd))
+        reqs += [("EXTRA", ec, eq) for ec, eq in zip(extra_codes, extra_qtds)]
+        out[code] = tuple((cat, ic, float(q)) for cat, ic, q in reqs if looks_like_code(ic))
     return out
 
 
+@st.cache_data(show_spinner=False)
 def index_bom_kits(df_kits: pd.DataFrame) -> dict:
     """
-    Retorna dict: codigo_final -> (componentes_codigos list, componentes_qtds list)
+    Retorna dict: codigo_final -> (componentes_codigos tuple, componentes_qtds tuple)
     """
     if df_kits.empty:
         return {}
     df = df_kits.copy()
     df.columns = [str(c).strip().lower() for c in df.columns]
-    required = ["codigo_final", "componentes_codigos", "componentes_qtds"]
-    for col in required:
-        if col not in df.columns:
-            raise KeyError(f"Aba bom_kits_conjuntos precisa da coluna: {col}")
+    missing = _KITS_REQUIRED_SET.difference(df.columns)
+    if missing:
+        col = next(c for c in KITS_REQUIRED if c in missing)
+        raise KeyError(f"Aba bom_kits_conjuntos precisa da coluna: {col}")
+
+    df["codigo_final"] = normalize_code_series(df["codigo_final"])
+    df = df[df["codigo_final"] != ""]
 
     out = {}
-    for _, r in df.iterrows():
-        code = str(r["codigo_final"]).strip()
-        if not code or code.lower() == "nan":
-            continue
-        comps = split_csv_like(r["componentes_codigos"])
-        qtds = parse_number_list(r["componentes_qtds"])
+    for code, comps_raw, qtds_raw in zip(
+        df["codigo_final"].to_numpy(),
+        df["componentes_codigos"].to_numpy(),
+        df["componentes_qtds"].to_numpy(),
+    ):
+        comps = split_csv_like(comps_raw)
+        qtds = parse_number_list(qtds_raw)
         # se qtds vier menor, completa com 1
         if len(qtds) < len(comps):
-            qtds = qtds + [1.0] * (len(comps) - len(qtds))
+            qtds = qtds + (1.0,) * (len(comps) - len(qtds))
         out[code] = (comps, qtds[: len(comps)])
     return out
 
@@ -314,9 +530,19 @@ def index_bom_kits(df_kits: pd.DataFrame) -> dict:
 def available_stock(stock_map: dict, code: str) -> float:
     """
     Estoque "usável": se negativo, considera 0.
+    (stock_map já vem com floats normalizados de build_stock_map.)
+    """
+    q = stock_map.get(code, 0.0)
+    return q if q > 0.0 else 0.0
+
+
+def register_missing_bom(code: str, qty: float, missing_bom: dict, debug_rows):
+    """
+    Produto sem BOM cadastrada: acumula em missing_bom e registra no debug.
     """
-    q = float(stock_map.get(code, 0.0))
-    return max(0.0, q)
+    missing_bom[code] += qty
+    if debug_rows is not None:
+        debug_rows.append({"tipo": "sem_bom", "codigo": code, "qtd": qty, "detalhe": "Não cadastrado em BOM"})
 
 
 def explode_product(
@@ -326,9 +552,8 @@ def explode_product(
     bom_simple_idx: dict,
     bom_kits_idx: dict,
     req_insumos: dict,
-    debug_rows: list,
-    missing_bom: dict,
-    visited_stack=None
+    debug_rows,
+    missing_bom: dict
 ):
     """
     Explode BOM para produzir qty_needed unidades do 'code' (faltante).
@@ -336,209 +561,248 @@ def explode_product(
     Para KIT: explode em componentes, mas só explode componente se ele não tiver estoque suficiente.
     Para simples: explode em semi/gola/bordado/extras.
     Se code não estiver em nenhuma BOM: entra em missing_bom.
-    """
-    if visited_stack is None:
-        visited_stack = []
+    req_insumos e missing_bom devem ser defaultdict(float) (acumulam com +=).
+    debug_rows=None desliga o registro de debug.
 
-    # evita loop infinito por cadastro errado
-    if code in visited_stack:
-        missing_bom[code] = missing_bom.get(code, 0.0) + qty_needed
-        debug_rows.append({"tipo": "loop_bom", "codigo": code, "qtd": qty_needed, "detalhe": "Loop detectado"})
-        return
-
-    visited_stack = visited_stack + [code]
+    Iterativo (pilha explícita) em vez de recursivo: mesma ordem de visita
+    em profundidade, sem custo de frames e sem limite de recursão.
+    """
 
-    # 1) Se for KIT/CONJUNTO
-    if code in bom_kits_idx:
-        comps, qtds = bom_kits_idx[code]
-        debug_rows.append({"tipo": "explode_kit", "codigo": code, "qtd": qty_needed, "detalhe": f"{len(comps)} comps"})
+    def kit_filhos(kit_code: str, kit_qty: float, comps: tuple, qtds: tuple):
+        # gera sob demanda os componentes que faltam, na ordem do cadastro;
+        # o debug de cada componente sai antes da explosão dele (como na recursão)
         for comp_code, comp_per in zip(comps, qtds):
-            comp_need = float(qty_needed) * float(comp_per)
+            comp_need = float(kit_qty) * float(comp_per)
             comp_have = available_stock(stock_map, comp_code)
             comp_falt = max(0.0, comp_need - comp_have)
 
-            debug_rows.append({
-                "tipo": "kit_comp",
-                "codigo_pai": code,
-                "codigo": comp_code,
-                "precisa": comp_need,
-                "tem": comp_have,
-                "faltante": comp_falt
-            })
+            if debug_rows is not None:
+                debug_rows.append({
+                    "tipo": "kit_comp",
+                    "codigo_pai": kit_code,
+                    "codigo": comp_code,
+                    "precisa": comp_need,
+                    "tem": comp_have,
+                    "faltante": comp_falt
+                })
 
             # Se tem componente suficiente, NÃO explode
-            if comp_falt <= 0:
-                continue
-
-            # Se falta componente, explode o componente (recursivo)
-            explode_product(
-                comp_code, comp_falt, stock_map, bom_simple_idx, bom_kits_idx,
-                req_insumos, debug_rows, missing_bom, visited_stack
-            )
-        return
-
-    # 2) Se for simples com insumos
-    if code in bom_simple_idx:
-        r = bom_simple_idx[code]
-
-        semi_code = str(r.get("semi_codigo", "")).strip()
-        semi_qtd = safe_float(r.get("semi_qtd", 0), 0)
-
-        gola_codes = split_csv_like(r.get("gola_codigo", ""))
-        gola_qtds = parse_number_list(r.get("gola_qtd", ""))
-
-        bord_code = str(r.get("bordado_codigo", "")).strip()
-        bord_qtd = safe_float(r.get("bordado_qtd", 0), 0)
-
-        extra_codes = split_csv_like(r.get("extras_codigos", ""))
-        extra_qtds = parse_number_list(r.get("extras_qtds", ""))
-
-        # Ajustes de tamanhos
-        if len(gola_qtds) < len(gola_codes):
-            gola_qtds = gola_qtds + [1.0] * (len(gola_codes) - len(gola_qtds))
-        if len(extra_qtds) < len(extra_codes):
-            extra_qtds = extra_qtds + [1.0] * (len(extra_codes) - len(extra_qtds))
-
-        debug_rows.append({"tipo": "explode_simples", "codigo": code, "qtd": qty_needed, "detalhe": "insumos"})
-
-        def add_req(insumo_code: str, per_unit: float, categoria: str):
-            insumo_code = str(insumo_code).strip()
-            if not insumo_code or insumo_code.lower() == "nan":
-                return
-            total = float(qty_needed) * float(per_unit)
-            key = (categoria, insumo_code)
-            req_insumos[key] = req_insumos.get(key, 0.0) + total
-
-        # semi
-        add_req(semi_code, semi_qtd, "SEMI")
+            if comp_falt > 0:
+                yield comp_code, comp_falt
+
+    # pilha de (filhos pendentes, kit pai); caminho = kits abertos na pilha (set: O(1) no teste de loop)
+    pilha = [(iter(((code, qty_needed),)), None)]
+    caminho = set()
+    while pilha:
+        pendentes, pai = pilha[-1]
+        item = next(pendentes, None)
+        if item is None:
+            pilha.pop()
+            caminho.discard(pai)
+            continue
+        code, qty_needed = item
 
-        # gola
-        for gc, gq in zip(gola_codes, gola_qtds):
-            add_req(gc, gq, "GOLA")
+        # evita loop infinito por cadastro errado
+        if code in caminho:
+            missing_bom[code] += qty_needed
+            if debug_rows is not None:
+                debug_rows.append({"tipo": "loop_bom", "codigo": code, "qtd": qty_needed, "detalhe": "Loop detectado"})
+            continue
 
-        # bordado
-        if bord_code and bord_code.lower() != "nan":
-            add_req(bord_code, bord_qtd, "BORDADO")
+        # 1) Se for KIT/CONJUNTO
+        if code in bom_kits_idx:
+            comps, qtds = bom_kits_idx[code]
+            if debug_rows is not None:
+                debug_rows.append({"tipo": "explode_kit", "codigo": code, "qtd": qty_needed, "detalhe": f"{len(comps)} comps"})
+            caminho.add(code)
+            pilha.append((kit_filhos(code, qty_needed, comps, qtds), code))
+            continue
 
-        # extras
-        for ec, eq in zip(extra_codes, extra_qtds):
-            add_req(ec, eq, "EXTRA")
+        # 2) Se for simples com insumos
+        if code in bom_simple_idx:
+            if debug_rows is not None:
+                debug_rows.append({"tipo": "explode_simples", "codigo": code, "qtd": qty_needed, "detalhe": "insumos"})
 
-        return
+            # insumos já vêm parseados, alinhados e filtrados de index_bom_simples
+            for categoria, insumo_code, per_unit in bom_simple_idx[code]:
+                req_insumos[(categoria, insumo_code)] += float(qty_needed) * per_unit
+            continue
 
-    # 3) Sem BOM cadastrada
-    missing_bom[code] = missing_bom.get(code, 0.0) + qty_needed
-    debug_rows.append({"tipo": "sem_bom", "codigo": code, "qtd": qty_needed, "detalhe": "Não cadastrado em BOM"})
+        # 3) Sem BOM cadastrada
+        register_missing_bom(code, qty_needed, missing_bom, debug_rows)
 
 
 # =========================
 # Report builder
 # =========================
-def build_reports(vendas_df, stock_map, bom_simple_idx, bom_kits_idx):
-    debug_rows = []
-    req_insumos = {}  # (categoria, codigo) -> requerido
-    missing_bom = {}  # codigo -> qtd
+# colunas do debug: eventos de produto (tipo/codigo/qtd/detalhe) + componentes de kit
+DEBUG_COLS = ["tipo", "codigo", "qtd", "detalhe", "codigo_pai", "precisa", "tem", "faltante"]
 
-    # 1) Faltantes de produto final (regra: se tem estoque suficiente, não explode)
-    faltantes_rows = []
-    for _, r in vendas_df.iterrows():
-        code = str(r["codigo"]).strip()
-        demanda = float(r["quantidade"])
-        tem = available_stock(stock_map, code)
-        falt = max(0.0, demanda - tem)
-
-        faltantes_rows.append({
-            "codigo": code,
-            "demanda": demanda,
-            "estoque_atual": tem,
-            "faltante": falt
-        })
 
-        # explode só o faltante
-        if falt > 0:
-            explode_product(
-                code=code,
-                qty_needed=falt,
-                stock_map=stock_map,
-                bom_simple_idx=bom_simple_idx,
-                bom_kits_idx=bom_kits_idx,
-                req_insumos=req_insumos,
-                debug_rows=debug_rows,
-                missing_bom=missing_bom
-            )
+def build_reports(vendas_df, stock_map, bom_simple_idx, bom_kits_idx, debug: bool = True):
+    # sem debug, nada é registrado na explosão (df_debug sai vazio)
+    debug_rows = [] if debug else None
+    req_insumos = defaultdict(float)  # (categoria, codigo) -> requerido
+    missing_bom = defaultdict(float)  # codigo -> qtd
 
-    df_faltantes = pd.DataFrame(faltantes_rows)
-    df_faltantes = df_faltantes.sort_values(["faltante", "demanda"], ascending=[False, False]).reset_index(drop=True)
+    # 1) Faltantes de produto final (regra: se tem estoque suficiente, não explode)
+    # Conciliação vendas x estoque vetorizada; só quem tem faltante segue para a explosão.
+    # estoque como Series: disponibilidade em lote (mesma regra de available_stock: negativo/NaN -> 0)
+    stock_s = pd.Series(stock_map, dtype="float64")
+
+    codes = vendas_df["codigo"].astype(str).str.strip().to_numpy()
+    demanda = vendas_df["quantidade"].to_numpy(dtype=float)
+    tem = stock_s.reindex(codes, fill_value=0.0).clip(lower=0.0).fillna(0.0).to_numpy()
+    falt = np.maximum(0.0, demanda - tem)
+
+    # explode só o faltante; quem não está em nenhuma BOM vai direto para missing_bom
+    need = falt > 0
+    for code, qty in zip(codes[need], falt[need]):
+        if code not in bom_kits_idx and code not in bom_simple_idx:
+            register_missing_bom(code, float(qty), missing_bom, debug_rows)
+            continue
+        explode_product(
+            code=code,
+            qty_needed=float(qty),
+            stock_map=stock_map,
+            bom_simple_idx=bom_simple_idx,
+            bom_kits_idx=bom_kits_idx,
+            req_insumos=req_insumos,
+            debug_rows=debug_rows,
+            missing_bom=missing_bom
+        )
 
-    # 2) Insumos agregados
-    ins_rows = []
-    for (cat, ins_code), req in req_insumos.items():
-        tem = available_stock(stock_map, ins_code)
-        falt = max(0.0, float(req) - float(tem))
-        if falt <= 0:
-            status = "OK"
-        elif tem > 0:
-            status = "PARCIAL"
-        else:
-            status = "FALTANDO"
+    # ordena nos arrays (faltante desc, demanda desc; lexsort é estável) e monta o frame já ordenado
+    order = np.lexsort((-demanda, -falt))
+    df_faltantes = pd.DataFrame({
+        "codigo": codes[order],
+        "demanda": demanda[order],
+        "estoque_atual": tem[order],
+        "faltante": falt[order]
+    })
 
-        ins_rows.append({
-            "categoria": cat,
-            "codigo": ins_code,
-            "requerido": float(req),
-            "estoque_atual": tem,
+    # 2) Insumos agregados
+    if req_insumos:
+        cats, ins_codes = zip(*req_insumos.keys())
+        req = np.fromiter(req_insumos.values(), dtype=float, count=len(req_insumos))
+        tem = stock_s.reindex(ins_codes, fill_value=0.0).clip(lower=0.0).fillna(0.0).to_numpy()
+        falt = np.maximum(0.0, req - tem)
+        status = np.where(falt <= 0, "OK", np.where(tem > 0, "PARCIAL", "FALTANDO"))
+        # status asc, faltante desc, requerido desc
+        order = np.lexsort((-req, -falt, status))
+        cats = np.asarray(cats, dtype=object)[order]
+        ins_codes = np.asarray(ins_codes, dtype=object)[order]
+        falt = falt[order]
+        df_insumos = pd.DataFrame({
+            "categoria": cats,
+            "codigo": ins_codes,
+            "requerido": req[order],
+            "estoque_atual": tem[order],
             "faltante": falt,
-            "status": status
+            "status": status[order]
         })
-
-    df_insumos = pd.DataFrame(ins_rows)
-    if not df_insumos.empty:
-        df_insumos = df_insumos.sort_values(["status", "faltante", "requerido"], ascending=[True, False, False]).reset_index(drop=True)
+        # insumos a fabricar: máscara direto nos arrays, sem reselecionar o frame
+        fab = falt > 0
+    else:
+        df_insumos = pd.DataFrame()
+        fab = None
 
     # 3) Lista de ação (FABRICAR)
-    acao_rows = []
+    acao_cols = ["acao", "tipo", "categoria", "codigo", "quantidade", "observacao"]
+    partes = []
 
     # insumos faltantes
-    if not df_insumos.empty:
-        for _, r in df_insumos.iterrows():
-            if float(r["faltante"]) > 0:
-                acao_rows.append({
-                    "acao": "FABRICAR",
-                    "tipo": "INSUMO",
-                    "categoria": r["categoria"],
-                    "codigo": r["codigo"],
-                    "quantidade": float(r["faltante"]),
-                    "observacao": "PLATELEIRA ESTOQUE"
-                })
+    if fab is not None and fab.any():
+        partes.append(pd.DataFrame({
+            "acao": "FABRICAR",
+            "tipo": "INSUMO",
+            "categoria": cats[fab],
+            "codigo": ins_codes[fab],
+            "quantidade": falt[fab],
+            "observacao": "PLATELEIRA ESTOQUE"
+        }, columns=acao_cols))
 
     # produtos sem BOM cadastrada
-    for code, qty in missing_bom.items():
-        acao_rows.append({
+    if missing_bom:
+        partes.append(pd.DataFrame({
             "acao": "CADASTRAR_BOM",
             "tipo": "PRODUTO",
             "categoria": "N/A",
-            "codigo": code,
-            "quantidade": float(qty),
+            "codigo": list(missing_bom.keys()),
+            "quantidade": np.fromiter(missing_bom.values(), dtype=float, count=len(missing_bom)),
             "observacao": "Sem BOM cadastrada (bom_produto_simples / bom_kits_conjuntos)"
-        })
+        }, columns=acao_cols))
 
-    df_acao = pd.DataFrame(acao_rows)
+    df_acao = pd.concat(partes, ignore_index=True) if partes else pd.DataFrame()
     if not df_acao.empty:
-        df_acao = df_acao.sort_values(["acao", "tipo", "quantidade"], ascending=[True, True, False]).reset_index(drop=True)
+        # acao asc, tipo asc, quantidade desc
+        order = np.lexsort((-df_acao["quantidade"].to_numpy(dtype=float), df_acao["tipo"].to_numpy(), df_acao["acao"].to_numpy()))
+        df_acao = df_acao.take(order).reset_index(drop=True)
 
-    df_debug = pd.DataFrame(debug_rows)
+    df_debug = pd.DataFrame.from_records(debug_rows or [], columns=DEBUG_COLS)
 
     return df_faltantes, df_insumos, df_acao, df_debug
 
 
+def excel_rows(df: pd.DataFrame):
+    """
+    Linhas do DataFrame para gravação em streaming; NaN/NA viram célula vazia
+    (como no to_excel do pandas).
+    """
+    values = df.astype(object).where(df.notna(), None)
+    return values.itertuples(index=False, name=None)
+
+
+def write_xlsx_xlsxwriter(output, sheets: list):
+    """
+    XlsxWriter em constant_memory: cada linha é gravada e liberada na hora
+    (as linhas precisam sair em ordem, por isso a escrita é linha a linha).
+    Texto com cara de URL fica como texto (strings_to_urls desligado), como no openpyxl.
+    """
+    import xlsxwriter
+
+    wb = xlsxwriter.Workbook(output, {"constant_memory": True, "strings_to_urls": False})
+    bold = wb.add_format({"bold": True})
+    for sheet_name, df in sheets:
+        ws = wb.add_worksheet(sheet_name)
+        ws.write_row(0, 0, [str(c) for c in df.columns], bold)
+        for i, row in enumerate(excel_rows(df), start=1):
+            ws.write_row(i, 0, row)
+    wb.close()
+
+
+def write_xlsx_openpyxl(output, sheets: list):
+    """
+    openpyxl em modo write_only: as linhas são gravadas em streaming,
+    sem montar a planilha inteira de células em memória.
+    """
+    wb = Workbook(write_only=True)
+    header_font = Font(bold=True)
+    for sheet_name, df in sheets:
+        ws = wb.create_sheet(title=sheet_name)
+        header = []
+        for col in df.columns:
+            cell = WriteOnlyCell(ws, value=str(col))
+            cell.font = header_font
+            header.append(cell)
+        ws.append(header)
+        for row in excel_rows(df):
+            ws.append(row)
+    wb.save(output)
+
+
 def to_excel_bytes(dfs: dict) -> bytes:
+    """
+    Gera o .xlsx com o XlsxWriter (constant_memory) quando disponível,
+    senão com o openpyxl em write_only.
+    """
+    sheets = [(name[:31], df) for name, df in dfs.items() if isinstance(df, pd.DataFrame)]
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        for sheet_name, df in dfs.items():
-            if df is None:
-                continue
-            if isinstance(df, pd.DataFrame):
-                df.to_excel(writer, sheet_name=sheet_name[:31], index=False)
+    try:
+        write_xlsx_xlsxwriter(output, sheets)
+    except ImportError:
+        output = io.BytesIO()
+        write_xlsx_openpyxl(output, sheets)
     return output.getvalue()
 
 
@@ -583,9 +847,9 @@ with tab2:
 
         if st.button("🔎 Validar leitura agora"):
             try:
-                df_template = load_sheet_as_df(spreadsheet_id, gid_template_estoque)
-                df_simple = load_sheet_as_df(spreadsheet_id, gid_bom_produto_simples)
-                df_kits = load_sheet_as_df(spreadsheet_id, gid_bom_kits_conjuntos)
+                df_template, df_simple, df_kits = load_sheets_as_dfs(
+                    spreadsheet_id, [gid_template_estoque, gid_bom_produto_simples, gid_bom_kits_conjuntos]
+                )
 
                 st.success("Leitura OK ✅")
 
@@ -637,9 +901,9 @@ with tab1:
 
     with st.spinner("Lendo planilhas do Google Sheets..."):
         try:
-            df_template = load_sheet_as_df(spreadsheet_id, gid_template_estoque)
-            df_simple = load_sheet_as_df(spreadsheet_id, gid_bom_produto_simples)
-            df_kits = load_sheet_as_df(spreadsheet_id, gid_bom_kits_conjuntos)
+            df_template, df_simple, df_kits = load_sheets_as_dfs(
+                spreadsheet_id, [gid_template_estoque, gid_bom_produto_simples, gid_bom_kits_conjuntos]
+            )
         except Exception as e:
             st.error(f"Falha ao ler Google Sheets: {e}")
             st.stop()
@@ -655,13 +919,16 @@ with tab1:
     st.markdown("### Vendas (agrupadas)")
     st.dataframe(vendas_df, use_container_width=True, height=260)
 
+    gerar_debug = st.checkbox("Gerar debug da explosão (mais lento em vendas grandes)", value=True)
+
     if st.button("🔥 Gerar Explosão BOM (Produção)"):
         with st.spinner("Explodindo BOM..."):
             df_faltantes, df_insumos, df_acao, df_debug = build_reports(
                 vendas_df=vendas_df,
                 stock_map=stock_map,
                 bom_simple_idx=bom_simple_idx,
-                bom_kits_idx=bom_kits_idx
+                bom_kits_idx=bom_kits_idx,
+                debug=gerar_debug
             )
 
         st.success("Explosão concluída ✅")
@@ -678,15 +945,16 @@ with tab1:
         st.markdown("### 03) Insumos requeridos (até nível de Semi / Gola / Bordado / Extras)")
         st.dataframe(df_insumos, use_container_width=True, height=360)
 
-        with st.expander("99) Debug (para caçar erro de lógica)"):
-            st.dataframe(df_debug, use_container_width=True, height=420)
+        if gerar_debug:
+            with st.expander("99) Debug (para caçar erro de lógica)"):
+                st.dataframe(df_debug, use_container_width=True, height=420)
 
         # Download Excel
         report_bytes = to_excel_bytes({
             "01_FALTANTES_PRODUTOS": df_faltantes,
             "03_INSUMOS": df_insumos,
             "04_LISTA_ACAO": df_acao,
-            "99_DEBUG": df_debug
+            "99_DEBUG": df_debug if gerar_debug else None
         })
 
         ts = time.strftime("%Y%m%d_%H%M%S")